@@ -28,14 +28,55 @@ http://sortedfile.readthedocs.org/
 # we subtract one from `lo` if it is provided to the bisect() functions to
 # ensure the user's full intended line is seen.
 
+import bisect
+import collections
 import functools
+import hashlib
+import heapq
 import itertools
+import math
 import os
+import struct
+import threading
+import zlib
 
 try:
+    import mmap
     from mmap import mmap as _mmap
 except ImportError:
-    _mmap = None
+    mmap = _mmap = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                           ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                              ctypes.POINTER(ctypes.c_ubyte)]
+    _libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long,
+                                    ctypes.c_long, ctypes.c_int]
+except (ImportError, OSError, AttributeError, TypeError):
+    _libc = None
+
+# Finds the address of a read-only mapping, where mmap lacks madvise().
+if _libc is not None and hasattr(ctypes.pythonapi, 'PyObject_AsReadBuffer'):
+    _as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+    _as_read_buffer.argtypes = [ctypes.py_object,
+                                ctypes.POINTER(ctypes.c_void_p),
+                                ctypes.POINTER(ctypes.c_ssize_t)]
+else:
+    _as_read_buffer = None
+
+# Linux values, used where the mmap module does not provide them.
+MADV_RANDOM = getattr(mmap, 'MADV_RANDOM', 1)
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', 2)
+MADV_HUGEPAGE = getattr(mmap, 'MADV_HUGEPAGE', 14)
+POSIX_FADV_RANDOM = getattr(os, 'POSIX_FADV_RANDOM', 1)
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
 
 
 def getsize(fp):
@@ -51,6 +92,27 @@ def getsize(fp):
         raise ValueError("can't get size of %r" % (fp,))
 
 
+def estimate_count(fp, hi=None, sample=65536, framing=None):
+    """Estimate the number of lines, or records delimited by `framing`, in the
+    seekable file `fp` by counting those in its first `sample` bytes."""
+    hi = hi or getsize(fp)
+    fp.seek(0)
+    if framing is None or framing is LINES:
+        s = fp.read(min(hi, sample))
+        lines = s.count('\n')
+        size = len(s)
+    else:
+        lines = 0
+        size = 0
+        read = framing.reader(fp)
+        while size < min(hi, sample) and read():
+            lines += 1
+            size = fp.tell()
+    if not lines:
+        return 1
+    return int(hi * lines / float(size)) + 1
+
+
 def warm(fp, lo=None, hi=None):
     """Encourage the seekable file `fp` to become cached by reading from it
     sequentially."""
@@ -63,52 +125,260 @@ def warm(fp, lo=None, hi=None):
         hi -= len(s) if s else hi
 
 
-def bisect_seek_left(fp, x, lo=None, hi=None, key=None):
+class SeparatorFraming(object):
+    """Framing for records terminated by the single or multi byte string `sep`,
+    which is included in records as with ``readline()``. Records are located
+    by searching blocks of `blocksize` bytes, except when `sep` is a newline,
+    in which case ``readline()`` is used."""
+
+    def __init__(self, sep='\n', blocksize=4096):
+        self.sep = sep
+        self.blocksize = blocksize
+
+    def sync(self, fp, offset):
+        """Position the seekable file `fp` on the first record starting after
+        `offset`, or at the start of the file if `offset` is 0, returning its
+        offset."""
+        if not offset:
+            fp.seek(0)
+            return 0
+        offset = max(0, offset - len(self.sep) + 1)
+        fp.seek(offset)
+        return offset + len(self.read(fp))
+
+    def read(self, fp):
+        """Read the record at the current position of `fp`, returning the
+        empty string at EOF."""
+        if self.sep == '\n':
+            return fp.readline()
+
+        sep = self.sep
+        keep = len(sep) - 1
+        pieces = []
+        tail = ''
+        while True:
+            block = fp.read(self.blocksize)
+            if not block:
+                pieces.append(tail)
+                return ''.join(pieces)
+            s = tail + block
+            i = s.find(sep)
+            if i != -1:
+                end = i + len(sep)
+                fp.seek(end - len(s), 1)
+                pieces.append(s[:end])
+                return ''.join(pieces)
+            pieces.append(s[:len(s) - keep])
+            tail = s[len(s) - keep:]
+
+    def reader(self, fp):
+        """Return a function that reads successive records from `fp`."""
+        if self.sep == '\n':
+            return fp.readline
+        return functools.partial(self.read, fp)
+
+    def complete(self, record):
+        """Return True if `record` ends with the separator, i.e. was not
+        truncated by EOF."""
+        return record.endswith(self.sep)
+
+    def last(self, fp, lo, hi):
+        """Return the final record of `fp` between `lo` and `hi`, without its
+        trailing separator."""
+        sep = self.sep
+        size = self.blocksize
+        while True:
+            offset = max(lo, hi - size)
+            fp.seek(offset)
+            s = fp.read(hi - offset)
+            while s.endswith(sep):
+                s = s[:-len(sep)]
+            _, found, high = s.rpartition(sep)
+            if found or offset == lo:
+                return high
+            size *= 2
+
+
+#: Default framing, for newline terminated lines.
+LINES = SeparatorFraming()
+
+
+class BlockFraming(object):
+    """Framing for length prefixed binary records that may contain any byte.
+    The file is divided into `blocksize` byte blocks, and records are split
+    into fragments that never cross a block boundary, each preceded by a
+    header containing its CRC32, length and whether it begins, continues or
+    ends a record. Records must be written using :py:meth:`write`.
+
+    Since each block begins with a header, finding the record following any
+    offset requires walking at most one block of headers plus one header per
+    block spanned by a long record, without reading record data."""
+
+    HEADER = struct.Struct('<IHB')
+    FULL, FIRST, MIDDLE, LAST = range(1, 5)
+
+    def __init__(self, blocksize=32768):
+        if not (self.HEADER.size < blocksize <= 0xffff + self.HEADER.size):
+            raise ValueError('blocksize must be between %d and %d: %r' %
+                             (self.HEADER.size + 1, 0xffff + self.HEADER.size,
+                              blocksize))
+        self.blocksize = blocksize
+
+    def write(self, fp, record):
+        """Append `record` to the writable file `fp`, positioned at its end.
+        Since an empty record would be read as EOF, raise ValueError if
+        `record` is empty."""
+        if not record:
+            raise ValueError('records must not be empty')
+        header = self.HEADER
+        pos = fp.tell()
+        first = True
+        while True:
+            left = self.blocksize - (pos % self.blocksize)
+            if left < header.size:
+                fp.write('\0' * left)
+                pos += left
+                continue
+            frag = record[:left - header.size]
+            record = record[len(frag):]
+            if first:
+                kind = self.FIRST if record else self.FULL
+            else:
+                kind = self.MIDDLE if record else self.LAST
+            crc = zlib.crc32(frag, kind) & 0xffffffff
+            fp.write(header.pack(crc, len(frag), kind) + frag)
+            pos += header.size + len(frag)
+            first = False
+            if not record:
+                return
+
+    def _next(self, fp, pos):
+        """Return ``(pos, crc, length, kind)`` for the fragment at or after
+        `pos`, skipping block padding, or None at EOF. `fp` is left positioned
+        on the fragment's data."""
+        header = self.HEADER
+        while True:
+            left = self.blocksize - (pos % self.blocksize)
+            if left >= header.size:
+                fp.seek(pos)
+                s = fp.read(header.size)
+                if len(s) < header.size:
+                    return None
+                crc, length, kind = header.unpack(s)
+                if kind:
+                    return pos, crc, length, kind
+            pos += left
+
+    def sync(self, fp, offset):
+        """Position the seekable file `fp` on the first record starting after
+        `offset`, or at the start of the file if `offset` is 0, returning its
+        offset."""
+        if not offset:
+            fp.seek(0)
+            return 0
+        pos = offset - (offset % self.blocksize)
+        while True:
+            frag = self._next(fp, pos)
+            if frag is None:
+                fp.seek(pos)
+                return pos
+            pos, _, length, kind = frag
+            if pos > offset and kind in (self.FULL, self.FIRST):
+                fp.seek(pos)
+                return pos
+            pos += self.HEADER.size + length
+
+    def read(self, fp):
+        """Read the record at the current position of `fp`, returning the
+        empty string at EOF or if the record is incomplete."""
+        header = self.HEADER
+        pos = fp.tell()
+        pieces = None
+        while True:
+            frag = self._next(fp, pos)
+            if frag is None:
+                return ''
+            pos, crc, length, kind = frag
+            data = fp.read(length)
+            if len(data) < length:
+                return ''
+            if crc != zlib.crc32(data, kind) & 0xffffffff:
+                raise ValueError('bad record checksum at offset %d' % pos)
+            pos += header.size + length
+            if kind in (self.FULL, self.FIRST):
+                pieces = [data]
+            elif pieces is not None:
+                pieces.append(data)
+            if kind in (self.FULL, self.LAST) and pieces is not None:
+                return ''.join(pieces)
+
+    def reader(self, fp):
+        """Return a function that reads successive records from `fp`."""
+        return functools.partial(self.read, fp)
+
+    def complete(self, record):
+        """Return True, since :py:meth:`read` never returns incomplete
+        records."""
+        return True
+
+    def last(self, fp, lo, hi):
+        """Return the final record of `fp` starting between `lo` and `hi`."""
+        block = (hi - 1) - ((hi - 1) % self.blocksize)
+        while (block + self.blocksize) > lo:
+            pos = self.sync(fp, max(lo, block and (block - 1)))
+            high = ''
+            while lo <= pos < hi:
+                s = self.read(fp)
+                if not s:
+                    break
+                high = s
+                pos = fp.tell()
+            if high:
+                return high
+            block -= self.blocksize
+        return ''
+
+
+def bisect_seek_left(fp, x, lo=None, hi=None, key=None, framing=None):
     """Position the sorted seekable file `fp` such that all preceding lines are
     less than `x`. If `x` is present, the file is positioned on its first
     occurrence."""
     lo = (lo - 1) if lo else 0
     hi = hi or getsize(fp)
     key = key or (lambda s: s)
+    framing = framing or LINES
 
     while lo < hi:
         mid = (lo + hi) // 2
-        fp.seek(mid)
-        if mid:
-            fp.readline()
-        s = fp.readline()
+        framing.sync(fp, mid)
+        s = framing.read(fp)
         if s and key(s) < x:
             lo = mid + 1
         else:
             hi = mid
 
-    fp.seek(lo)
-    if lo:
-        fp.readline()
+    framing.sync(fp, lo)
 
 
-def bisect_seek_right(fp, x, lo=None, hi=None, key=None):
+def bisect_seek_right(fp, x, lo=None, hi=None, key=None, framing=None):
     """Position the sorted seekable file `fp` such that all subsequent lines
     are greater than `x`. If `x` is present, the file is positioned past its
     last occurrence."""
     lo = (lo - 1) if lo else 0
     hi = hi or getsize(fp)
     key = key or (lambda s: s)
+    framing = framing or LINES
 
     while lo < hi:
         mid = (lo + hi) // 2
-        fp.seek(mid)
-        if mid:
-            fp.readline()
-        s = fp.readline()
-        if s and x < key(s):
+        framing.sync(fp, mid)
+        s = framing.read(fp)
+        if (not s) or x < key(s):
             hi = mid
         else:
             lo = mid + 1
 
-    fp.seek(lo)
-    if lo:
-        fp.readline()
+    framing.sync(fp, lo)
 
 
 def bisect_seek_fixed_left(fp, n, x, lo=None, hi=None, key=None):
@@ -117,8 +387,8 @@ def bisect_seek_fixed_left(fp, n, x, lo=None, hi=None, key=None):
     first occurrence."""
     lo = lo or 0
     key = key or (lambda s: s)
-    rlo = lo / n
-    rhi = (hi or getsize(fp)) / n
+    rlo = 0
+    rhi = ((hi or getsize(fp)) - lo) // n
 
     while rlo < rhi:
         mid = (rlo + rhi) // 2
@@ -138,19 +408,123 @@ def bisect_seek_fixed_right(fp, n, x, lo=None, hi=None, key=None):
     past its last occurrence."""
     lo = lo or 0
     key = key or (lambda s: s)
-    rlo = lo / n
-    rhi = (hi or getsize(fp)) / n
+    rlo = 0
+    rhi = ((hi or getsize(fp)) - lo) // n
+
+    while rlo < rhi:
+        mid = (rlo + rhi) // 2
+        fp.seek(lo + (mid * n))
+        s = fp.read(n)
+        if (not s) or x < key(s):
+            rhi = mid
+        else:
+            rlo = mid + 1
+
+    fp.seek(lo + (rlo * n))
+
+
+def equal_range(fp, x, lo=None, hi=None, key=None, framing=None):
+    """Return a tuple of the offsets of the first line equal to `x` in the
+    sorted seekable file `fp` and of the line following the last, as found by
+    :py:func:`bisect_seek_left` and :py:func:`bisect_seek_right`. Probes are
+    shared until a line equal to `x` is found, after which each bound is
+    searched for separately. The file is positioned on the first offset."""
+    lo = (lo - 1) if lo else 0
+    hi = hi or getsize(fp)
+    key = key or (lambda s: s)
+    framing = framing or LINES
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        framing.sync(fp, mid)
+        s = framing.read(fp)
+        k = key(s) if s else None
+        if s and k < x:
+            lo = mid + 1
+        elif (not s) or x < k:
+            hi = mid
+        else:
+            rlo, rhi = mid + 1, hi
+            hi = mid
+            break
+    else:
+        rlo = rhi = lo
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        framing.sync(fp, mid)
+        s = framing.read(fp)
+        if s and key(s) < x:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    while rlo < rhi:
+        mid = (rlo + rhi) // 2
+        framing.sync(fp, mid)
+        s = framing.read(fp)
+        if (not s) or x < key(s):
+            rhi = mid
+        else:
+            rlo = mid + 1
+
+    end = framing.sync(fp, rlo)
+    return framing.sync(fp, lo), end
+
+
+def equal_range_fixed(fp, n, x, lo=None, hi=None, key=None):
+    """Return a tuple of the offsets of the first `n` byte record equal to `x`
+    in the sorted seekable file `fp` and of the record following the last, as
+    for :py:func:`equal_range`. The file is positioned on the first
+    offset."""
+    lo = lo or 0
+    key = key or (lambda s: s)
+    rlo = 0
+    rhi = ((hi or getsize(fp)) - lo) // n
 
     while rlo < rhi:
         mid = (rlo + rhi) // 2
         fp.seek(lo + (mid * n))
         s = fp.read(n)
-        if s and x < key(s):
+        k = key(s) if s else None
+        if s and k < x:
+            rlo = mid + 1
+        elif (not s) or x < k:
             rhi = mid
         else:
+            elo, ehi = mid + 1, rhi
+            rhi = mid
+            break
+    else:
+        elo = ehi = rlo
+
+    while rlo < rhi:
+        mid = (rlo + rhi) // 2
+        fp.seek(lo + (mid * n))
+        s = fp.read(n)
+        if s and key(s) < x:
             rlo = mid + 1
+        else:
+            rhi = mid
+
+    while elo < ehi:
+        mid = (elo + ehi) // 2
+        fp.seek(lo + (mid * n))
+        s = fp.read(n)
+        if (not s) or x < key(s):
+            ehi = mid
+        else:
+            elo = mid + 1
 
     fp.seek(lo + (rlo * n))
+    return lo + (rlo * n), lo + (elo * n)
+
+
+def count_fixed(fp, n, x, lo=None, hi=None, key=None):
+    """Return the number of `n` byte records equal to `x` in the sorted
+    seekable file `fp`, without reading them."""
+    start, end = equal_range_fixed(fp, n, x, lo, hi, key)
+    return (end - start) // n
 
 
 def bisect_func_left(x, lo, hi, func):
@@ -175,7 +549,7 @@ def bisect_func_right(x, lo, hi, func):
     while lo < hi:
         mid = (lo + hi) // 2
         k = func(mid)
-        if k is not None and x < k:
+        if k is None or x < k:
             hi = mid
         else:
             lo = mid + 1
@@ -183,19 +557,15 @@ def bisect_func_right(x, lo, hi, func):
     return lo, k
 
 
-def extents(fp, lo=None, hi=None):
+def extents(fp, lo=None, hi=None, framing=None):
     """Return a tuple of the first and last lines from the seekable file
     `fp`."""
     lo = (lo - 1) if lo else 0
     hi = hi or getsize(fp)
-    bisect_seek_left(fp, '', lo, hi)
-    low = fp.readline()
-
-    for offset in xrange(0, 1048576, 4096):
-        fp.seek(hi - offset)
-        _, sep, high = fp.read(offset - 1).rstrip('\n').rpartition('\n')
-        if sep:
-            return low, high
+    framing = framing or LINES
+    bisect_seek_left(fp, '', lo, hi, framing=framing)
+    low = framing.read(fp)
+    return low, framing.last(fp, lo, hi)
 
 
 def extents_fixed(fp, n, lo=None, hi=None):
@@ -210,22 +580,24 @@ def extents_fixed(fp, n, lo=None, hi=None):
     return low, fp.read(n)
 
 
-def iter_inclusive(fp, x, y, lo=None, hi=None, key=None):
+def iter_inclusive(fp, x, y, lo=None, hi=None, key=None, framing=None):
     """Iterate lines of the sorted seekable file `fp` satisfying
     `x <= line <= y`."""
     key = key or (lambda s: s)
-    bisect_seek_left(fp, x, lo, hi, key)
+    framing = framing or LINES
+    bisect_seek_left(fp, x, lo, hi, key, framing)
     pred = lambda s: x <= key(s) <= y
-    return itertools.takewhile(pred, iter(fp.readline, ''))
+    return itertools.takewhile(pred, iter(framing.reader(fp), ''))
 
 
-def iter_exclusive(fp, x, y, lo=None, hi=None, key=None):
+def iter_exclusive(fp, x, y, lo=None, hi=None, key=None, framing=None):
     """Iterate lines of the sorted seekable file `fp` satisfying
     `x < line < y`."""
     key = key or (lambda s: s)
-    bisect_seek_right(fp, x, lo, hi, key)
+    framing = framing or LINES
+    bisect_seek_right(fp, x, lo, hi, key, framing)
     pred = lambda s: x < key(s) < y
-    return itertools.takewhile(pred, iter(fp.readline, ''))
+    return itertools.takewhile(pred, iter(framing.reader(fp), ''))
 
 
 def iter_fixed_inclusive(fp, n, x, y, lo=None, hi=None, key=None):
@@ -244,3 +616,877 @@ def iter_fixed_exclusive(fp, n, x, y, lo=None, hi=None, key=None):
     bisect_seek_fixed_right(fp, n, x, lo, hi, key)
     pred = lambda s: x < key(s) < y
     return itertools.takewhile(pred, iter(functools.partial(fp.read, n), ''))
+
+
+def iter_equal(fp, x, lo=None, hi=None, key=None, bloom=None,
+        framing=None):
+    """Iterate lines of the sorted seekable file `fp` equal to `x`. If the
+    :py:class:`BloomFilter` `bloom` reports `x` is absent, no search is
+    performed."""
+    if bloom is not None and x not in bloom:
+        return iter(())
+    return iter_inclusive(fp, x, x, lo, hi, key, framing)
+
+
+def iter_fixed_equal(fp, n, x, lo=None, hi=None, key=None, bloom=None):
+    """Iterate `n` byte records of the sorted seekable file `fp` equal to `x`.
+    If the :py:class:`BloomFilter` `bloom` reports `x` is absent, no search is
+    performed."""
+    if bloom is not None and x not in bloom:
+        return iter(())
+    return iter_fixed_inclusive(fp, n, x, x, lo, hi, key)
+
+
+_BLOOM_MAGIC = 'SFB1'
+_BLOOM_HEADER = struct.Struct('<4sIQQQ')
+
+
+class BloomFilter(object):
+    """Bloom filter stored in a memory mapped sidecar file, recording the keys
+    of a sorted file so that lookups for absent keys can be rejected without
+    seeking. Keys are hashed by their ``str()`` representation. Instances
+    should be obtained via :py:func:`bloom_create`, :py:func:`bloom_open` or
+    :py:func:`bloom_build`.
+
+    `nbits`, `nhashes` and `count` describe the filter, while `offset` is the
+    byte offset in the data file up to which records have been added. If
+    `readonly` is true, the mapping cannot be written."""
+
+    def __init__(self, buf, readonly=False):
+        self.buf = buf
+        self.readonly = readonly
+        magic, self.nhashes, self.nbits, self.count, self.offset = \
+            _BLOOM_HEADER.unpack(buf[:_BLOOM_HEADER.size])
+        if magic != _BLOOM_MAGIC:
+            raise ValueError('not a bloom filter: %r' % (magic,))
+
+    def _bits(self, k):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(k)).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + (i * h2)) % self.nbits
+
+    def __contains__(self, k):
+        buf = self.buf
+        base = _BLOOM_HEADER.size
+        for bit in self._bits(k):
+            if not ord(buf[base + (bit >> 3)]) & (1 << (bit & 7)):
+                return False
+        return True
+
+    def add(self, k):
+        """Add the key `k` to the filter."""
+        buf = self.buf
+        base = _BLOOM_HEADER.size
+        for bit in self._bits(k):
+            i = base + (bit >> 3)
+            buf[i] = chr(ord(buf[i]) | (1 << (bit & 7)))
+        self.count += 1
+
+    def update(self, fp, hi=None, key=None, n=None, framing=None):
+        """Add the keys of records appended to the seekable file `fp` since
+        `offset`, up to `hi`. If `n` is given `fp` contains `n` byte records,
+        otherwise records are read using `framing`. Incomplete trailing
+        records are left for a later update, so the final line of `fp` must
+        end with a newline."""
+        key = key or (lambda s: s)
+        hi = hi or getsize(fp)
+        framing = framing or LINES
+        read = functools.partial(fp.read, n) if n else framing.reader(fp)
+        pos = self.offset
+        fp.seek(pos)
+        for s in iter(read, ''):
+            end = (pos + len(s)) if n else fp.tell()
+            if end > hi or (n and len(s) < n) or not (n or
+                                                      framing.complete(s)):
+                break
+            self.add(key(s))
+            pos = end
+        self.offset = pos
+        self.flush()
+
+    def flush(self):
+        """Write the filter header and flush the mapping to disk, unless the
+        filter is read only."""
+        if self.readonly:
+            return
+        self.buf[:_BLOOM_HEADER.size] = _BLOOM_HEADER.pack(_BLOOM_MAGIC,
+            self.nhashes, self.nbits, self.count, self.offset)
+        self.buf.flush()
+
+    def close(self):
+        """Flush and unmap the filter."""
+        self.flush()
+        self.buf.close()
+
+
+def bloom_create(path, capacity, error_rate=0.01):
+    """Create an empty :py:class:`BloomFilter` sidecar at `path` sized to hold
+    `capacity` keys with a false positive rate of `error_rate`."""
+    capacity = max(1, capacity)
+    nbits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+    nbits = max(8, int(math.ceil(nbits)))
+    nhashes = max(1, int(round(math.log(2) * nbits / capacity)))
+    with open(path, 'w+b') as fp:
+        fp.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, nhashes, nbits, 0, 0))
+        fp.truncate(_BLOOM_HEADER.size + ((nbits + 7) // 8))
+    return bloom_open(path)
+
+
+def bloom_open(path, readonly=False):
+    """Map an existing :py:class:`BloomFilter` sidecar at `path`. If `readonly`
+    is true, the filter cannot be updated."""
+    with open(path, 'rb' if readonly else 'r+b') as fp:
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        return BloomFilter(_mmap(fp.fileno(), 0, access=access), readonly)
+
+
+def bloom_build(path, fp, capacity=None, error_rate=0.01, hi=None, key=None,
+        n=None, framing=None):
+    """Create a :py:class:`BloomFilter` sidecar at `path` containing the keys
+    of every `n` byte record, or record delimited by `framing`, of the
+    seekable file `fp` in a single pass. `capacity` defaults to the record
+    count of `fp`, estimated using :py:func:`estimate_count` for variable
+    length records. Allow for growth if data will be appended later."""
+    hi = hi or getsize(fp)
+    if capacity is None:
+        capacity = (hi // n) if n else estimate_count(fp, hi, framing=framing)
+    bloom = bloom_create(path, capacity, error_rate)
+    bloom.update(fp, hi, key, n, framing)
+    return bloom
+
+
+class Cursor(object):
+    """Position within the sorted seekable file `fp` that is remembered
+    between calls, for visiting records or searching for keys in ascending
+    order. If `n` is given `fp` contains `n` byte records, otherwise lines.
+    `lo`, `hi`, `key` and `framing` are as for the search functions; `lo` is
+    the initial position. Iterating a cursor yields records from its current
+    position.
+
+    Since the cursor seeks `fp` before every access, `fp` may be shared with
+    other cursors or functions."""
+
+    def __init__(self, fp, n=None, lo=None, hi=None, key=None, framing=None):
+        self.fp = fp
+        self.n = n
+        self.hi = hi or getsize(fp)
+        self.key = key or (lambda s: s)
+        self.framing = framing or LINES
+        self.seek(lo or 0)
+
+    def __iter__(self):
+        return self
+
+    def tell(self):
+        """Return the offset of the current record."""
+        return self.pos
+
+    def seek(self, pos):
+        """Position the cursor on the record starting at offset `pos`."""
+        self.pos = pos
+        self._cur = None
+        self._end = None
+
+    def peek(self):
+        """Return the current record without advancing, or the empty string
+        at EOF."""
+        if self._cur is None:
+            if self.pos >= self.hi:
+                self._cur = ''
+                self._end = self.pos
+            elif self.n:
+                self.fp.seek(self.pos)
+                self._cur = self.fp.read(self.n)
+                self._end = self.pos + len(self._cur)
+            else:
+                self.fp.seek(self.pos)
+                self._cur = self.framing.read(self.fp)
+                self._end = self.fp.tell()
+        return self._cur
+
+    def next(self):
+        """Return the current record and advance past it, raising
+        StopIteration at EOF."""
+        s = self.peek()
+        if (not s) or (self.n and len(s) < self.n):
+            raise StopIteration
+        self.seek(self._end)
+        return s
+
+    def seek_forward(self, x):
+        """Advance the cursor to the first record at or following the current
+        position that is not less than `x`, returning it as for
+        :py:meth:`peek`. Exponential search from the current position is used,
+        so the cost is logarithmic in the distance moved rather than the size
+        of the file."""
+        s = self.peek()
+        if s and self.key(s) < x:
+            if self.n:
+                self._gallop_fixed(x)
+            else:
+                self._gallop(x, self._end)
+        return self.peek()
+
+    def _gallop(self, x, lo):
+        fp, key, hi, framing = self.fp, self.key, self.hi, self.framing
+        fp.seek(lo)
+        s = framing.read(fp)
+        if s and lo < hi and key(s) < x:
+            step = max(1, fp.tell() - lo)
+            lo += step
+            while True:
+                offset = lo + step
+                if offset >= hi:
+                    break
+                start = framing.sync(fp, offset)
+                s = framing.read(fp)
+                if start >= hi:
+                    break
+                if not (s and key(s) < x):
+                    hi = start
+                    break
+                lo = fp.tell()
+                step *= 2
+
+            if lo < hi:
+                # lo and hi are record starts; bisect_seek_left() expects hi to
+                # precede the first record it may return.
+                bisect_seek_left(fp, x, lo, hi - 1, key, framing)
+                lo = fp.tell()
+        self.seek(lo)
+
+    def _gallop_fixed(self, x):
+        fp, key, n = self.fp, self.key, self.n
+        lo = self.pos + n
+        hi = lo + (((self.hi - lo) // n) * n)
+        step = 0
+        while lo < hi:
+            offset = lo + step
+            if offset >= hi:
+                break
+            fp.seek(offset)
+            s = fp.read(n)
+            if not (len(s) == n and key(s) < x):
+                hi = offset
+                break
+            lo = offset + n
+            step = (step * 2) or n
+
+        if lo < hi:
+            bisect_seek_fixed_left(fp, n, x, lo, hi, key)
+            lo = fp.tell()
+        self.seek(lo)
+
+
+def _join(left, right, outer):
+    """Yield ``(k, l, mark)`` for records `l` of `left` with key `k`, where
+    `mark` is the offset of the first record of `right` with an equal key. If
+    `outer` is true, records without a match are yielded with a `mark` of
+    None, otherwise they are skipped using :py:meth:`Cursor.seek_forward`."""
+    lkey, rkey = left.key, right.key
+    l = left.peek()
+    while l:
+        k = lkey(l)
+        r = right.seek_forward(k)
+        if r and not k < rkey(r):
+            mark = right.tell()
+            while l and not k < lkey(l):
+                yield k, l, mark
+                left.next()
+                l = left.peek()
+        elif outer:
+            yield k, l, None
+            left.next()
+            l = left.peek()
+        elif r:
+            l = left.seek_forward(rkey(r))
+        else:
+            break
+
+
+def join_inner(left, right):
+    """Iterate ``(l, r)`` for every pair of records from the
+    :py:class:`Cursor` instances `left` and `right` having equal keys. Both
+    cursors are consumed."""
+    rkey = right.key
+    for k, l, mark in _join(left, right, False):
+        right.seek(mark)
+        r = right.peek()
+        while r and not k < rkey(r):
+            yield l, r
+            right.next()
+            r = right.peek()
+
+
+def join_left(left, right):
+    """Like :py:func:`join_inner`, except records of `left` without a match
+    are included as ``(l, None)``."""
+    rkey = right.key
+    for k, l, mark in _join(left, right, True):
+        if mark is None:
+            yield l, None
+            continue
+        right.seek(mark)
+        r = right.peek()
+        while r and not k < rkey(r):
+            yield l, r
+            right.next()
+            r = right.peek()
+
+
+def join_semi(left, right):
+    """Iterate records from the :py:class:`Cursor` `left` having at least one
+    record with an equal key in the :py:class:`Cursor` `right`."""
+    for k, l, mark in _join(left, right, False):
+        yield l
+
+
+#: Summary of a field over a set of records, as returned by
+#: :py:func:`aggregate_range`.
+Aggregate = collections.namedtuple('Aggregate', 'count min max sum')
+
+
+def _summarize(records, fields):
+    """Return a list of :py:class:`Aggregate` for each function in `fields`
+    applied to `records`."""
+    aggs = [[0, None, None, 0] for _ in fields]
+    for s in records:
+        for agg, field in itertools.izip(aggs, fields):
+            v = field(s)
+            agg[0] += 1
+            agg[1] = v if agg[1] is None else min(agg[1], v)
+            agg[2] = v if agg[2] is None else max(agg[2], v)
+            agg[3] += v
+    return [Aggregate(*agg) for agg in aggs]
+
+
+def _combine(a, b):
+    """Combine the :py:class:`Aggregate` `a` and `b`."""
+    if not a.count:
+        return b
+    if not b.count:
+        return a
+    return Aggregate(a.count + b.count, min(a.min, b.min), max(a.max, b.max),
+                     a.sum + b.sum)
+
+
+_ZONE_MAGIC = 'SFZ1'
+_ZONE_HEADER = struct.Struct('<4sIIQ')
+_ZONE_BLOCK = struct.Struct('<QQQII')
+_ZONE_INT = struct.Struct('<cq')
+_ZONE_FLOAT = struct.Struct('<cd')
+
+
+def _pack_number(v):
+    if isinstance(v, float) or not (-(2 ** 63) <= v < (2 ** 63)):
+        return _ZONE_FLOAT.pack('f', v)
+    return _ZONE_INT.pack('i', v)
+
+
+def _unpack_number(s):
+    if s[0] == 'f':
+        return _ZONE_FLOAT.unpack(s)[1]
+    return _ZONE_INT.unpack(s)[1]
+
+
+class ZoneMap(object):
+    """Summaries of consecutive blocks of records from a sorted file, allowing
+    :py:func:`aggregate_range` to avoid reading most records. Instances
+    should be obtained via :py:func:`zonemap_build` or
+    :py:func:`zonemap_open`.
+
+    `blocks` is a list of ``(start, end, first, last, aggs)`` tuples, giving
+    the offsets of the block's first record and the record following it, its
+    first and last records, and a list of :py:class:`Aggregate` for each of
+    `nfields` fields. Each block contains `blocksize` records, except
+    possibly the last."""
+
+    def __init__(self, blocks, nfields, blocksize):
+        self.blocks = blocks
+        self.nfields = nfields
+        self.blocksize = blocksize
+        self.starts = [block[0] for block in blocks]
+        self.ends = [block[1] for block in blocks]
+
+    def save(self, path):
+        """Write the zone map to `path`."""
+        with open(path, 'wb') as fp:
+            fp.write(_ZONE_HEADER.pack(_ZONE_MAGIC, self.nfields,
+                                       self.blocksize, len(self.blocks)))
+            for start, end, first, last, aggs in self.blocks:
+                fp.write(_ZONE_BLOCK.pack(start, end, aggs[0].count
+                                          if aggs else 0,
+                                          len(first), len(last)))
+                fp.write(first + last)
+                for agg in aggs:
+                    fp.write(''.join(map(_pack_number, agg[1:])))
+
+
+def zonemap_open(path):
+    """Load a :py:class:`ZoneMap` sidecar previously written to `path`."""
+    with open(path, 'rb') as fp:
+        magic, nfields, blocksize, nblocks = \
+            _ZONE_HEADER.unpack(fp.read(_ZONE_HEADER.size))
+        if magic != _ZONE_MAGIC:
+            raise ValueError('not a zone map: %r' % (magic,))
+
+        size = _ZONE_INT.size
+        blocks = []
+        for _ in xrange(nblocks):
+            start, end, count, nfirst, nlast = \
+                _ZONE_BLOCK.unpack(fp.read(_ZONE_BLOCK.size))
+            first = fp.read(nfirst)
+            last = fp.read(nlast)
+            aggs = []
+            for _ in xrange(nfields):
+                s = fp.read(3 * size)
+                aggs.append(Aggregate(count, *[_unpack_number(s[i:i + size])
+                                               for i in (0, size, 2 * size)]))
+            blocks.append((start, end, first, last, aggs))
+        return ZoneMap(blocks, nfields, blocksize)
+
+
+def zonemap_build(path, fp, fields, blocksize=4096, lo=None, n=None,
+        framing=None):
+    """Create a :py:class:`ZoneMap` sidecar at `path` summarizing each
+    `blocksize` records of the sorted seekable file `fp` in a single pass.
+    `fields` is a list of functions mapping records to integers or floats to
+    be summarized; integers outside the 64 bit range are stored as floats.
+    If `n` is given `fp` contains `n` byte records, otherwise records are read
+    using `framing`."""
+    framing = framing or LINES
+    read = functools.partial(fp.read, n) if n else framing.reader(fp)
+    start = lo or 0
+    fp.seek(start)
+    blocks = []
+    while True:
+        records = []
+        for s in iter(read, ''):
+            if n and len(s) < n:
+                break
+            records.append(s)
+            if len(records) == blocksize:
+                break
+        if not records:
+            break
+        end = fp.tell()
+        blocks.append((start, end, records[0], records[-1],
+                       _summarize(records, fields)))
+        start = end
+
+    zones = ZoneMap(blocks, len(fields), blocksize)
+    zones.save(path)
+    return zones
+
+
+def aggregate_range(fp, zones, x, y, fields, lo=None, hi=None, key=None,
+        n=None, framing=None):
+    """Return a list of :py:class:`Aggregate` for each function in `fields`
+    over the records of the sorted seekable file `fp` satisfying
+    ``x <= record <= y``. Blocks of records entirely within the range are
+    answered from the :py:class:`ZoneMap` `zones`, so that only records in
+    the partially covered blocks at either end of the range are read.
+    `fields`, `n` and `framing` must match those used to build `zones`, and
+    ValueError is raised if the number of fields differs."""
+    if len(fields) != zones.nfields:
+        raise ValueError('zone map has %d fields, not %d' %
+                         (zones.nfields, len(fields)))
+    if n:
+        bisect_seek_fixed_left(fp, n, x, lo, hi, key)
+        start = fp.tell()
+        bisect_seek_fixed_right(fp, n, y, lo, hi, key)
+        end = fp.tell()
+    else:
+        bisect_seek_left(fp, x, lo, hi, key, framing)
+        start = fp.tell()
+        bisect_seek_right(fp, y, lo, hi, key, framing)
+        end = fp.tell()
+
+    def scan(pos, stop):
+        if pos >= stop:
+            return _summarize((), fields)
+        cursor = Cursor(fp, n=n, lo=pos, hi=stop, framing=framing)
+        return _summarize(cursor, fields)
+
+    first = bisect.bisect_left(zones.starts, start)
+    last = bisect.bisect_right(zones.ends, end)
+    if first >= last:
+        return scan(start, end)
+
+    aggs = scan(start, zones.starts[first])
+    for block in zones.blocks[first:last]:
+        aggs = map(_combine, aggs, block[4])
+    return map(_combine, aggs, scan(zones.ends[last - 1], end))
+
+
+_Run = collections.namedtuple('_Run', 'first last path fp size')
+
+
+def _closing(it, fps):
+    """Yield from `it`, closing each of `fps` once it is exhausted or
+    discarded."""
+    try:
+        for s in it:
+            yield s
+    finally:
+        for fp in fps:
+            fp.close()
+
+
+class SortedStore(object):
+    """Writable collection of sorted lines kept in the directory `path`, which
+    is created if necessary. Inserted lines are held in a sorted in-memory
+    table and logged to disk, until `memtable_size` lines have accumulated
+    and a background thread writes them out as a new sorted run file, while
+    inserts continue into a fresh table. `key` is as for the search
+    functions.
+
+    Once more than `max_runs` runs exist, the background thread merges the
+    newest runs, together with any preceding runs no larger than
+    `merge_ratio` times the size merged so far. Runs therefore form tiers of
+    increasing size, and large runs are rewritten only rarely.
+
+    Lines from an existing directory, including any logged but not yet
+    written to a run, are recovered on construction. The log is flushed but
+    not synced to disk after each insert."""
+
+    def __init__(self, path, key=None, memtable_size=65536, max_runs=4,
+            merge_ratio=4):
+        self.path = path
+        self.key = key or (lambda s: s)
+        self.memtable_size = memtable_size
+        self.max_runs = max_runs
+        self.merge_ratio = merge_ratio
+        self._lock = threading.Lock()
+        self._compact_lock = threading.RLock()
+        self._flushed = threading.Condition(self._lock)
+        self._compactor = None
+        self._frozen = []
+        self._memtable = []
+        self._seq = itertools.count()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recover()
+
+    def _path(self, first, last=None):
+        if last is None:
+            return os.path.join(self.path, 'log-%08d' % first)
+        return os.path.join(self.path, 'run-%08d-%08d' % (first, last))
+
+    def _recover(self):
+        runs = []
+        logs = []
+        for name in os.listdir(self.path):
+            parts = name.split('-')
+            if name.endswith('.tmp'):
+                os.unlink(os.path.join(self.path, name))
+            elif parts[0] == 'run' and len(parts) == 3:
+                runs.append((int(parts[1]), int(parts[2])))
+            elif parts[0] == 'log' and len(parts) == 2:
+                logs.append(int(parts[1]))
+
+        # A run contained by another was merged before a crash.
+        self._runs = []
+        for first, last in sorted(runs):
+            if any(f <= first and last <= l and (f, l) != (first, last)
+                   for f, l in runs):
+                os.unlink(self._path(first, last))
+            else:
+                self._runs.append(self._open_run(first, last))
+
+        # A log covered by a run was written out before a crash.
+        self._logs = []
+        for gen in sorted(logs):
+            if (any(run.first <= gen <= run.last for run in self._runs) or
+                    not os.path.getsize(self._path(gen))):
+                os.unlink(self._path(gen))
+                continue
+            with open(self._path(gen), 'rb') as fp:
+                for line in fp:
+                    if line.endswith('\n'):
+                        self._add(line)
+            self._logs.append(gen)
+
+        self._gen = 1 + max([run.last for run in self._runs] + logs + [0])
+        self._open_log()
+
+    def _open_run(self, first, last):
+        path = self._path(first, last)
+        return _Run(first, last, path, open(path, 'rb'),
+                    os.path.getsize(path))
+
+    def _open_log(self):
+        self._logs.append(self._gen)
+        self._log = open(self._path(self._gen), 'ab')
+
+    def _add(self, line):
+        bisect.insort(self._memtable, (self.key(line), next(self._seq), line))
+
+    def _write(self, path, lines):
+        """Atomically write the iterable `lines` to `path`."""
+        with open(path + '.tmp', 'wb') as fp:
+            fp.writelines(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _merge(self, its):
+        """Merge the sorted line iterators `its`."""
+        key = self.key
+        decorated = [((key(s), i, seq, s) for seq, s in enumerate(it))
+                     for i, it in enumerate(its)]
+        return (s for _, _, _, s in heapq.merge(*decorated))
+
+    def insert(self, line):
+        """Insert `line`, which must end with, and contain no other,
+        newline."""
+        if line.count('\n') != 1 or not line.endswith('\n'):
+            raise ValueError('line must end with a single newline: %r' %
+                             (line,))
+        with self._lock:
+            self._log.write(line)
+            self._log.flush()
+            self._add(line)
+            if len(self._memtable) >= self.memtable_size:
+                self._freeze()
+                while len(self._frozen) > 1:
+                    self._flushed.wait()
+
+    def flush(self):
+        """Write any lines held in memory to a new run file, and wait for
+        background work to complete."""
+        with self._lock:
+            if self._memtable:
+                self._freeze()
+        self.wait()
+
+    def _freeze(self):
+        """Queue the memtable and its logs to be written by the background
+        thread, and start a new memtable and log. The caller must hold
+        `_lock`."""
+        self._log.close()
+        self._frozen.append((self._memtable, self._logs))
+        self._memtable = []
+        self._logs = []
+        self._gen += 1
+        self._open_log()
+        self._schedule()
+
+    def _write_frozen(self, memtable, logs):
+        """Write the oldest frozen memtable to a run file. The caller must
+        hold `_compact_lock`."""
+        first, last = logs[0], logs[-1]
+        self._write(self._path(first, last),
+                    (line for _, _, line in memtable))
+        with self._lock:
+            self._runs.append(self._open_run(first, last))
+            self._frozen.pop(0)
+            self._flushed.notify_all()
+        for gen in logs:
+            os.unlink(self._path(gen))
+
+    def _schedule(self):
+        """Start the background thread if a frozen memtable is waiting or
+        more than `max_runs` runs exist, and it is not running. The caller
+        must hold `_lock`."""
+        if ((self._frozen or len(self._runs) > self.max_runs) and
+                self._compactor is None):
+            self._compactor = threading.Thread(target=self._background)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _select(self):
+        """Return the newest runs that must be merged to satisfy `max_runs`,
+        extended by preceding runs of similar size, or None if no merge is
+        needed. The caller must hold `_lock`."""
+        runs = self._runs
+        if len(runs) <= self.max_runs:
+            return None
+        i = self.max_runs - 1
+        total = sum(run.size for run in runs[i:])
+        while i and runs[i - 1].size <= (self.merge_ratio * total):
+            i -= 1
+            total += runs[i].size
+        return runs[i:]
+
+    def _background(self):
+        try:
+            while True:
+                with self._compact_lock:
+                    with self._lock:
+                        frozen = self._frozen[:1]
+                        runs = None if frozen else self._select()
+                        if not (frozen or runs):
+                            self._compactor = None
+                            return
+                    if frozen:
+                        self._write_frozen(*frozen[0])
+                    else:
+                        self._merge_runs(runs)
+        except Exception:
+            with self._lock:
+                self._compactor = None
+                self._flushed.notify_all()
+            raise
+
+    def _merge_runs(self, runs):
+        """Merge the adjacent run files `runs` into one. The caller must hold
+        `_compact_lock`."""
+        first, last = runs[0].first, runs[-1].last
+        fps = [open(run.path, 'rb') for run in runs]
+        self._write(self._path(first, last),
+                    self._merge(iter(fp.readline, '') for fp in fps))
+        for fp in fps:
+            fp.close()
+
+        with self._lock:
+            i = self._runs.index(runs[0])
+            self._runs[i:i + len(runs)] = [self._open_run(first, last)]
+        for run in runs:
+            run.fp.close()
+            os.unlink(run.path)
+
+    def compact(self):
+        """Merge all current run files into one."""
+        with self._compact_lock:
+            with self._lock:
+                runs = list(self._runs)
+            if len(runs) > 1:
+                self._merge_runs(runs)
+        with self._lock:
+            self._schedule()
+
+    def wait(self):
+        """Wait for any background flush or merge to complete."""
+        while True:
+            compactor = self._compactor
+            if compactor is None:
+                return
+            compactor.join()
+
+    def iter_inclusive(self, x, y):
+        """Iterate lines of the store satisfying ``x <= line <= y``, merging
+        those held in memory with the results of :py:func:`iter_inclusive`
+        for each run file."""
+        with self._lock:
+            mems = [m for m, _ in self._frozen] + [self._memtable]
+            mems = [m[bisect.bisect_left(m, (x,)):
+                      bisect.bisect_right(m, (y, float('inf')))]
+                    for m in mems]
+            fps = [_mmap(run.fp.fileno(), 0, access=mmap.ACCESS_READ)
+                   for run in self._runs]
+
+        its = [iter_inclusive(fp, x, y, key=self.key) for fp in fps]
+        its.extend((line for _, _, line in mem) for mem in mems)
+        return _closing(self._merge(its), fps)
+
+    def close(self):
+        """Write lines held in memory to a run file, wait for any background
+        merge to complete, and close all files."""
+        self.flush()
+        self.wait()
+        with self._lock:
+            self._log.close()
+            for run in self._runs:
+                run.fp.close()
+
+
+#: Counts of choices made by :py:func:`open_sorted`, keyed by ``'file'``,
+#: ``'residency_unknown'``, and ``'mmap'``, ``'madvise'``, ``'fadvise'`` and
+#: their ``'_failed'`` variants.
+open_stats = collections.defaultdict(int)
+
+
+def residency(fp, hi=None, samples=64, window=256):
+    """Return the fraction of pages of the physical file `fp` that are present
+    in the operating system's page cache, or None if this cannot be
+    determined. For large files, `samples` evenly spaced runs of `window`
+    pages are checked using ``mincore()``."""
+    size = hi or getsize(fp)
+    if _libc is None or not size:
+        return None
+
+    page = mmap.PAGESIZE
+    addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED,
+                      fp.fileno(), 0)
+    if addr in (None, ctypes.c_void_p(-1).value):
+        return None
+
+    try:
+        npages = (size + page - 1) // page
+        if npages <= samples * window:
+            window, samples = npages, 1
+        vec = (ctypes.c_ubyte * window)()
+        resident = 0
+        for i in xrange(samples):
+            start = ((npages - window) * i) // max(1, samples - 1)
+            length = min(window * page, size - (start * page))
+            if _libc.mincore(addr + (start * page), length, vec):
+                return None
+            resident += sum(b & 1 for b in vec)
+        return resident / float(window * samples)
+    finally:
+        _libc.munmap(addr, size)
+
+
+def _advise(m, size, advice):
+    """Apply `advice` to the mmap.mmap `m` of `size` bytes, returning True on
+    success."""
+    try:
+        if hasattr(m, 'madvise'):
+            m.madvise(advice)
+            return True
+        if _as_read_buffer is None:
+            return False
+        addr = ctypes.c_void_p()
+        length = ctypes.c_ssize_t()
+        _as_read_buffer(m, ctypes.byref(addr), ctypes.byref(length))
+        return _libc.madvise(addr, min(size, length.value), advice) == 0
+    except (OSError, TypeError, ValueError):
+        return False
+
+
+def _count(name, ok):
+    open_stats[name if ok else (name + '_failed')] += 1
+
+
+def open_sorted(path, workload='point', n=None, threads=False, hot=0.5):
+    """Open the sorted file at `path` as a ``mmap.mmap`` if at least `hot` of
+    its pages are cached, otherwise as a buffered ``file``, advised for the
+    `workload` ``'point'`` or ``'scan'``. `n` is the record length of fixed
+    length files. If `threads` is true, only a fully cached file is mapped."""
+    if workload not in ('point', 'scan'):
+        raise ValueError('workload must be point or scan: %r' % (workload,))
+
+    with open(path, 'rb') as fp:
+        size = getsize(fp)
+        if size and _mmap is not None:
+            cached = residency(fp, size)
+            if cached is None:
+                open_stats['residency_unknown'] += 1
+            elif cached >= (0.99 if threads else hot):
+                try:
+                    m = _mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+                except mmap.error:
+                    open_stats['mmap_failed'] += 1
+                else:
+                    open_stats['mmap'] += 1
+                    advice = MADV_RANDOM if workload == 'point' \
+                        else MADV_SEQUENTIAL
+                    _count('madvise', _advise(m, size, advice))
+                    if size >= 2097152:
+                        _count('madvise', _advise(m, size, MADV_HUGEPAGE))
+                    return m
+
+        if workload == 'scan':
+            bufsize = 1048576
+        else:
+            bufsize = 2 * (n or (size // estimate_count(fp, size) or 1))
+        open_stats['file'] += 1
+
+    fp = open(path, 'rb', max(256, bufsize))
+    if _libc is not None:
+        advice = POSIX_FADV_RANDOM if workload == 'point' \
+            else POSIX_FADV_SEQUENTIAL
+        _count('fadvise', not _libc.posix_fadvise(fp.fileno(), 0, 0, advice))
+    return fp
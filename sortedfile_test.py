@@ -18,6 +18,11 @@
 from __future__ import absolute_import
 
 import cStringIO as StringIO
+import os
+import random
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 
@@ -99,6 +104,24 @@ class BisectTestCase(unittest.TestCase):
         io = StringIO.StringIO('')
         test(0, 0)
 
+    def test_bisect_right_last(self):
+        io = StringIO.StringIO(''.join('%-2d\n' % i for i in xrange(40)))
+        sortedfile.bisect_seek_right(io, 38, key=int)
+        self.assertEqual('39\n', io.readline())
+
+    def test_equal_range(self):
+        io = self.make_fp()
+        for x in (0, 1, 2, 2.5, 5, 9, 11):
+            sortedfile.bisect_seek_left(io, x, key=int)
+            start = io.tell()
+            sortedfile.bisect_seek_right(io, x, key=int)
+            end = io.tell()
+            self.assertEqual((start, end),
+                sortedfile.equal_range(io, x, key=int))
+            self.assertEqual(start, io.tell())
+        self.assertEqual((0, 0),
+            sortedfile.equal_range(StringIO.StringIO(''), 1))
+
     def test_extents(self):
         io = self.make_fp()
         low, high = sortedfile.extents(io)
@@ -163,6 +186,26 @@ class BisectFixedTestCase(unittest.TestCase):
         io = StringIO.StringIO('')
         test(0, 0)
 
+    def test_bisect_lo(self):
+        io = StringIO.StringIO('header\n' + self.make_fp().getvalue())
+        sortedfile.bisect_seek_fixed_left(io, 100, 2, lo=7, key=int)
+        self.assertEqual(1007, io.tell())
+        sortedfile.bisect_seek_fixed_right(io, 100, 2, lo=7, key=int)
+        self.assertEqual(2007, io.tell())
+
+    def test_equal_range(self):
+        io = self.make_fp()
+        for x in (0, 1, 2, 2.5, 5, 9, 11):
+            sortedfile.bisect_seek_fixed_left(io, 100, x, key=int)
+            start = io.tell()
+            sortedfile.bisect_seek_fixed_right(io, 100, x, key=int)
+            end = io.tell()
+            self.assertEqual((start, end),
+                sortedfile.equal_range_fixed(io, 100, x, key=int))
+            self.assertEqual(start, io.tell())
+        self.assertEqual(10, sortedfile.count_fixed(io, 100, 4, key=int))
+        self.assertEqual(0, sortedfile.count_fixed(io, 100, 4.5, key=int))
+
     def test_extents_fixed(self):
         io = self.make_fp()
         low, high = sortedfile.extents_fixed(io, 100)
@@ -188,5 +231,517 @@ class BisectFixedTestCase(unittest.TestCase):
             list(sortedfile.iter_fixed_inclusive(io, 100, 0, 0.5, key=int)))
 
 
+class BloomTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'bloom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_fp(self):
+        io = StringIO.StringIO()
+        for i in xrange(0, 1000, 2):
+            io.write('%d\n' % i)
+        return io
+
+    def test_build(self):
+        io = self.make_fp()
+        bloom = sortedfile.bloom_build(self.path, io, key=int)
+        self.assertEqual(500, bloom.count)
+        self.assertEqual(len(io.getvalue()), bloom.offset)
+        self.assertTrue(all(i in bloom for i in xrange(0, 1000, 2)))
+        false = sum(i in bloom for i in xrange(1, 1000, 2))
+        self.assertTrue(false < 25)
+
+    def test_reopen(self):
+        io = self.make_fp()
+        sortedfile.bloom_build(self.path, io, key=int).close()
+        bloom = sortedfile.bloom_open(self.path, readonly=True)
+        self.assertEqual(500, bloom.count)
+        self.assertTrue(998 in bloom)
+        bloom.close()
+
+    def test_update(self):
+        io = self.make_fp()
+        bloom = sortedfile.bloom_build(self.path, io, capacity=1000, key=int)
+        io.write('1000\n10')
+        bloom.update(io, key=int)
+        self.assertTrue(1000 in bloom)
+        self.assertEqual(501, bloom.count)
+        io.write('02\n')
+        bloom.update(io, key=int)
+        self.assertTrue(1002 in bloom)
+        self.assertEqual(len(io.getvalue()), bloom.offset)
+
+    def test_iter_equal(self):
+        io = self.make_fp()
+        bloom = sortedfile.bloom_build(self.path, io, key=int)
+        self.assertEqual(['10\n'],
+            list(sortedfile.iter_equal(io, 10, key=int, bloom=bloom)))
+        self.assertEqual([],
+            list(sortedfile.iter_equal(io, 11, key=int, bloom=bloom)))
+
+    def test_framing(self):
+        framing = sortedfile.SeparatorFraming('\0')
+        key = lambda s: int(s.rstrip('\0'))
+        io = StringIO.StringIO()
+        io.write(''.join('%d\0' % i for i in xrange(10, 20)))
+        bloom = sortedfile.bloom_build(self.path, io, key=key,
+                                       framing=framing)
+        self.assertEqual(10, bloom.count)
+        self.assertTrue(bloom.nbits > 8)
+        self.assertEqual(['15\0'], list(sortedfile.iter_equal(io, 15,
+            key=key, framing=framing, bloom=bloom)))
+        io.seek(0, 2)
+        io.write('20\0' + '21')
+        bloom.update(io, key=key, framing=framing)
+        self.assertEqual(11, bloom.count)
+        self.assertTrue(20 in bloom)
+
+    def test_iter_fixed_equal(self):
+        io = StringIO.StringIO(''.join('%-9d\n' % i for i in xrange(100)))
+        bloom = sortedfile.bloom_build(self.path, io, n=10, key=int)
+        self.assertEqual(100, bloom.count)
+        self.assertEqual(['%-9d\n' % 42], list(sortedfile.iter_fixed_equal(
+            io, 10, 42, key=int, bloom=bloom)))
+
+
+class CursorTestCase(unittest.TestCase):
+    def make_fp(self, fmt='%d\n'):
+        io = StringIO.StringIO()
+        for i in xrange(0, 1000, 2):
+            for j in xrange(1 + (i % 3)):
+                io.write(fmt % i)
+        return io
+
+    def check_seek_forward(self, io, n=None):
+        cursor = sortedfile.Cursor(io, n=n, key=int)
+        for x in range(-1, 1003, 3) + [2000]:
+            s = cursor.seek_forward(x)
+            if n:
+                sortedfile.bisect_seek_fixed_left(io, n, x, key=int)
+            else:
+                sortedfile.bisect_seek_left(io, x, key=int)
+            self.assertEqual(io.tell(), cursor.tell())
+            self.assertEqual(io.read(len(s)), s)
+        self.assertEqual('', cursor.peek())
+
+    def test_seek_forward(self):
+        self.check_seek_forward(self.make_fp())
+
+    def test_seek_forward_fixed(self):
+        self.check_seek_forward(self.make_fp('%-9d\n'), 10)
+
+    def test_seek_forward_backwards(self):
+        cursor = sortedfile.Cursor(self.make_fp(), key=int)
+        self.assertEqual('500\n', cursor.seek_forward(500))
+        self.assertEqual('500\n', cursor.seek_forward(10))
+
+    def test_next_peek(self):
+        cursor = sortedfile.Cursor(StringIO.StringIO('a\nb\nc\n'), lo=2)
+        self.assertEqual('b\n', cursor.peek())
+        self.assertEqual('b\n', cursor.next())
+        self.assertEqual(['c\n'], list(cursor))
+        self.assertEqual('', cursor.peek())
+        self.assertRaises(StopIteration, cursor.next)
+
+    def test_next_fixed(self):
+        io = StringIO.StringIO('a \nb \nc')
+        cursor = sortedfile.Cursor(io, n=3)
+        self.assertEqual(['a \n', 'b \n'], list(cursor))
+
+
+class JoinTestCase(unittest.TestCase):
+    LEFT = [1, 2, 2, 3, 5, 8, 8, 9, 40, 41]
+    RIGHT = [0, 2, 2, 2, 4, 5, 8, 10, 11, 12, 13, 14, 15, 41]
+
+    def make_cursor(self, keys, fmt):
+        io = StringIO.StringIO(''.join(fmt % k for k in keys))
+        return sortedfile.Cursor(io, n=10 if '9' in fmt else None,
+            key=lambda s: int(s.split(',')[0]))
+
+    def make_cursors(self):
+        return (self.make_cursor(self.LEFT, '%d,l\n'),
+                self.make_cursor(self.RIGHT, '%-9s\n' % '%d,r'))
+
+    def parse(self, s):
+        return s and int(s.split(',')[0])
+
+    def expect(self, outer):
+        out = []
+        for l in self.LEFT:
+            matches = [(l, r) for r in self.RIGHT if l == r]
+            out.extend(matches or ([(l, None)] if outer else []))
+        return out
+
+    def test_join_inner(self):
+        it = sortedfile.join_inner(*self.make_cursors())
+        self.assertEqual(self.expect(False),
+            [(self.parse(l), self.parse(r)) for l, r in it])
+
+    def test_join_left(self):
+        it = sortedfile.join_left(*self.make_cursors())
+        self.assertEqual(self.expect(True),
+            [(self.parse(l), self.parse(r)) for l, r in it])
+
+    def test_join_semi(self):
+        it = sortedfile.join_semi(*self.make_cursors())
+        self.assertEqual([2, 2, 5, 8, 8, 41], map(self.parse, it))
+
+    def test_join_empty(self):
+        empty = self.make_cursor([], '%d\n')
+        left, _ = self.make_cursors()
+        self.assertEqual([], list(sortedfile.join_inner(left, empty)))
+        left, _ = self.make_cursors()
+        self.assertEqual([(l, None) for l in self.LEFT],
+            [(self.parse(l), r) for l, r in sortedfile.join_left(left, empty)])
+
+
+class FramingTestCase(unittest.TestCase):
+    def check(self, io, framing, parse):
+        key = lambda s: parse(s)
+        def test(n, x, func):
+            func(io, x, key=key, framing=framing)
+            s = framing.read(io)
+            self.assertEqual(n, s and parse(s))
+
+        for i in xrange(1, 40):
+            test(i, i, sortedfile.bisect_seek_left)
+            test(i + 1 if i < 39 else '', i, sortedfile.bisect_seek_right)
+        test(1, 0, sortedfile.bisect_seek_left)
+        test('', 40, sortedfile.bisect_seek_left)
+
+        self.assertEqual([5, 6, 7], map(parse, sortedfile.iter_inclusive(io,
+            5, 7, key=key, framing=framing)))
+        self.assertEqual([6], map(parse, sortedfile.iter_exclusive(io,
+            5, 7, key=key, framing=framing)))
+        low, high = sortedfile.extents(io, framing=framing)
+        self.assertEqual((1, 39), (parse(low), parse(high)))
+
+        cursor = sortedfile.Cursor(io, key=key, framing=framing)
+        self.assertEqual(20, parse(cursor.seek_forward(20)))
+        self.assertEqual(20, parse(cursor.next()))
+        self.assertEqual(39, parse(cursor.seek_forward(39)))
+        self.assertEqual('', cursor.seek_forward(40))
+
+    def test_nul(self):
+        io = StringIO.StringIO(''.join('%d\n\0' % i for i in xrange(1, 40)))
+        self.check(io, sortedfile.SeparatorFraming('\0', 7),
+            lambda s: int(s.strip('\n\0')))
+
+    def test_crlf(self):
+        io = StringIO.StringIO(''.join('%d\r\n' % i for i in xrange(1, 40)))
+        self.check(io, sortedfile.SeparatorFraming('\r\n', 3), int)
+
+    def test_block(self):
+        framing = sortedfile.BlockFraming(64)
+        io = StringIO.StringIO()
+        for i in xrange(1, 40):
+            framing.write(io, '%d\n%s' % (i, '\n' * (i * 3)))
+        self.check(io, framing, int)
+
+    def test_block_read(self):
+        framing = sortedfile.BlockFraming(64)
+        io = StringIO.StringIO()
+        records = ['x' * i for i in xrange(1, 300, 7)]
+        for record in records:
+            framing.write(io, record)
+        io.seek(0)
+        self.assertEqual(records, list(iter(framing.reader(io), '')))
+        io.seek(0)
+        self.assertEqual(records[0], framing.read(io))
+        self.assertRaises(ValueError, framing.write, io, '')
+
+    def test_block_size(self):
+        self.assertRaises(ValueError, sortedfile.BlockFraming, 7)
+        self.assertRaises(ValueError, sortedfile.BlockFraming, 100000)
+        framing = sortedfile.BlockFraming(0xffff + 7)
+        io = StringIO.StringIO()
+        framing.write(io, 'x' * 200000)
+        io.seek(0)
+        self.assertEqual('x' * 200000, framing.read(io))
+
+
+class ZoneMapTestCase(unittest.TestCase):
+    FIELDS = [lambda s: int(s.split(',')[1]), lambda s: -int(s.split(',')[1])]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'zones')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def key(self, s):
+        return int(s.split(',')[0])
+
+    def make_fp(self, fmt='%d,%d\n'):
+        io = StringIO.StringIO()
+        for i in xrange(0, 1000, 2):
+            for j in xrange(1 + (i % 3)):
+                io.write(fmt % (i, (i * 7 + j) % 101))
+        return io
+
+    def check(self, io, zones, n=None):
+        for x, y in [(0, 1000), (-5, -1), (1001, 2000), (10, 10), (11, 11),
+                     (3, 97), (101, 899), (500, 530), (-1, 1)]:
+            if n:
+                it = sortedfile.iter_fixed_inclusive(io, n, x, y, key=self.key)
+            else:
+                it = sortedfile.iter_inclusive(io, x, y, key=self.key)
+            expect = sortedfile._summarize(list(it), self.FIELDS)
+            self.assertEqual(expect, sortedfile.aggregate_range(io, zones,
+                x, y, self.FIELDS, key=self.key, n=n))
+
+    def test_aggregate_range(self):
+        io = self.make_fp()
+        zones = sortedfile.zonemap_build(self.path, io, self.FIELDS,
+            blocksize=16)
+        self.assertEqual(0, self.key(zones.blocks[0][2]))
+        self.assertEqual(998, self.key(zones.blocks[-1][3]))
+        self.check(io, zones)
+        loaded = sortedfile.zonemap_open(self.path)
+        self.assertEqual(zones.blocks, loaded.blocks)
+        self.assertEqual((2, 16), (loaded.nfields, loaded.blocksize))
+        self.check(io, loaded)
+
+    def test_fields_mismatch(self):
+        io = self.make_fp()
+        zones = sortedfile.zonemap_build(self.path, io, self.FIELDS)
+        self.assertRaises(ValueError, sortedfile.aggregate_range, io, zones,
+            0, 10, self.FIELDS[:1], key=self.key)
+
+    def test_bad_magic(self):
+        with open(self.path, 'wb') as fp:
+            fp.write('\0' * 64)
+        self.assertRaises(ValueError, sortedfile.zonemap_open, self.path)
+
+    def test_numbers(self):
+        fields = [lambda s: float(s) / 2, lambda s: int(s) * (2 ** 62)]
+        zones = sortedfile.zonemap_build(self.path,
+            StringIO.StringIO('1\n2\n3\n'), fields)
+        loaded = sortedfile.zonemap_open(self.path)
+        self.assertEqual(zones.blocks, loaded.blocks)
+        self.assertEqual(sortedfile.Aggregate(3, 0.5, 1.5, 3.0),
+                         loaded.blocks[0][4][0])
+        self.assertEqual(6 * (2 ** 62), loaded.blocks[0][4][1].sum)
+
+    def test_aggregate_range_fixed(self):
+        io = self.make_fp('%-4d,%-4d\n')
+        zones = sortedfile.zonemap_build(self.path, io, self.FIELDS,
+            blocksize=16, n=10)
+        self.check(io, zones, 10)
+
+    def test_appended(self):
+        io = self.make_fp()
+        zones = sortedfile.zonemap_build(self.path, io, self.FIELDS,
+            blocksize=16)
+        io.write('1000,5\n1001,7\n')
+        aggs = sortedfile.aggregate_range(io, zones, 999, 2000, self.FIELDS,
+            key=self.key)
+        self.assertEqual(sortedfile.Aggregate(2, 5, 7, 12), aggs[0])
+
+
+class SortedStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_store(self):
+        return sortedfile.SortedStore(self.tmpdir, key=int, memtable_size=10,
+                                      max_runs=2)
+
+    def fill(self, store, count):
+        lines = ['%d\n' % random.randint(0, 99) for _ in xrange(count)]
+        for line in lines:
+            store.insert(line)
+        return sorted(lines, key=int)
+
+    def test_insert(self):
+        store = self.make_store()
+        lines = self.fill(store, 95)
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        self.assertEqual([l for l in lines if 20 <= int(l) <= 30],
+                         list(store.iter_inclusive(20, 30)))
+        store.wait()
+        self.assertTrue(len(store._runs) <= 3)
+        store.compact()
+        self.assertEqual(1, len(store._runs))
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        store.close()
+
+    def test_recover(self):
+        store = self.make_store()
+        lines = self.fill(store, 25)
+        store.wait()
+        store = self.make_store()
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        lines = sorted(lines + self.fill(store, 13), key=int)
+        store.close()
+        store = self.make_store()
+        self.assertEqual([], store._memtable)
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        store.close()
+
+    def test_write_amplification(self):
+        written = [0]
+        class Store(sortedfile.SortedStore):
+            def _write(self, path, lines):
+                lines = list(lines)
+                written[0] += len(lines)
+                sortedfile.SortedStore._write(self, path, lines)
+
+        store = Store(self.tmpdir, key=int, memtable_size=100, max_runs=4)
+        for i in xrange(20000):
+            store.insert('%d\n' % random.randint(0, 999999))
+            if not i % 1000:
+                store.wait()
+                self.assertTrue(len(store._runs) <= 4)
+        store.wait()
+        self.assertTrue(len(store._runs) <= 4)
+        # Merging every run each time wrote over 25 lines per insert.
+        self.assertTrue(written[0] < 20000 * 10, written[0])
+        self.assertEqual(20000, len(list(store.iter_inclusive(0, 999999))))
+        store.close()
+
+    def test_concurrent_writers(self):
+        store = sortedfile.SortedStore(self.tmpdir, key=int, memtable_size=20,
+                                       max_runs=4)
+        def writer(n):
+            for i in xrange(n, 4000, 4):
+                store.insert('%d\n' % i)
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.wait()
+        self.assertTrue(len(store._runs) <= 4)
+        self.assertEqual(map(str, xrange(4000)),
+                         [s.rstrip() for s in store.iter_inclusive(0, 4000)])
+        store.close()
+
+    def test_background_flush(self):
+        release = threading.Event()
+        class Store(sortedfile.SortedStore):
+            def _write(self, path, lines):
+                release.wait()
+                sortedfile.SortedStore._write(self, path, lines)
+
+        store = Store(self.tmpdir, key=int, memtable_size=10, max_runs=2)
+        lines = self.fill(store, 15)
+        # The full memtable is queued, not written, yet remains readable.
+        self.assertEqual(1, len(store._frozen))
+        self.assertEqual([], store._runs)
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        release.set()
+        store.flush()
+        self.assertEqual([], store._frozen)
+        self.assertEqual(2, len(store._runs))
+        self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+        store.close()
+
+    def test_iter_closes_maps(self):
+        store = self.make_store()
+        lines = self.fill(store, 25)
+        store.wait()
+        maps = []
+        class Map(sortedfile._mmap):
+            def __init__(self, *args, **kwargs):
+                maps.append(self)
+        mmap_, sortedfile._mmap = sortedfile._mmap, Map
+        try:
+            self.assertEqual(lines, list(store.iter_inclusive(0, 99)))
+            it = store.iter_inclusive(0, 99)
+            self.assertEqual(lines[0], next(it))
+            it.close()
+        finally:
+            sortedfile._mmap = mmap_
+        self.assertTrue(maps)
+        for m in maps:
+            self.assertRaises(ValueError, m.__getitem__, 0)
+        store.close()
+
+    def test_bad_line(self):
+        store = self.make_store()
+        self.assertRaises(ValueError, store.insert, '1')
+        self.assertRaises(ValueError, store.insert, '')
+        self.assertRaises(ValueError, store.insert, '1\n2\n')
+        store.close()
+
+
+class OpenSortedTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fp:
+            for i in xrange(10000):
+                fp.write('%-99d\n' % i)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def check(self, fp):
+        it = sortedfile.iter_fixed_inclusive(fp, 100, 500, 502, key=int)
+        self.assertEqual([500, 501, 502], map(int, it))
+        self.assertEqual([7], map(int, sortedfile.iter_equal(fp, 7, key=int)))
+
+    def test_residency(self):
+        with open(self.path, 'rb') as fp:
+            sortedfile.warm(fp)
+            cached = sortedfile.residency(fp)
+        if cached is None:
+            self.skipTest('page cache residency unavailable')
+        self.assertTrue(0 <= cached <= 1)
+
+    def test_open_hot(self):
+        with open(self.path, 'rb') as fp:
+            sortedfile.warm(fp)
+            cached = sortedfile.residency(fp)
+        if cached is None or cached < 0.5:
+            self.skipTest('file not cached, residency %r' % (cached,))
+        before = sortedfile.open_stats['mmap']
+        advised = sortedfile.open_stats['madvise']
+        fp = sortedfile.open_sorted(self.path)
+        self.assertTrue(isinstance(fp, sortedfile._mmap))
+        self.assertEqual(before + 1, sortedfile.open_stats['mmap'])
+        self.assertEqual(advised + 1, sortedfile.open_stats['madvise'])
+        self.assertRaises(TypeError, fp.write, 'x')
+        self.check(fp)
+        fp.close()
+
+    def test_open_mmap_failed(self):
+        with open(self.path, 'rb') as fp:
+            if sortedfile.residency(fp) is None:
+                self.skipTest('page cache residency unavailable')
+        class Map(sortedfile._mmap):
+            def __new__(cls, *args, **kwargs):
+                raise sortedfile.mmap.error(12, 'Cannot allocate memory')
+        failed = sortedfile.open_stats['mmap_failed']
+        mmap_, sortedfile._mmap = sortedfile._mmap, Map
+        try:
+            fp = sortedfile.open_sorted(self.path, hot=0)
+        finally:
+            sortedfile._mmap = mmap_
+        self.assertTrue(isinstance(fp, file))
+        self.assertEqual(failed + 1, sortedfile.open_stats['mmap_failed'])
+        self.check(fp)
+        fp.close()
+
+    def test_open_file(self):
+        before = sortedfile.open_stats['file']
+        fp = sortedfile.open_sorted(self.path, 'scan', hot=2)
+        self.assertTrue(isinstance(fp, file))
+        self.assertEqual(before + 1, sortedfile.open_stats['file'])
+        self.check(fp)
+        fp.close()
+
+    def test_bad_workload(self):
+        self.assertRaises(ValueError, sortedfile.open_sorted, self.path, 'x')
+
+
 if __name__ == '__main__':
     unittest.main()